@@ -0,0 +1,346 @@
+# ========== 離線效能測試 (不需任何金鑰) ==========
+# 以假的 gspread 工作表、Cloudinary uploader 與 Telegram Update 取代外部服務，
+# 在 1k / 10k / 100k 筆遊戲商、多個聊天室同時操作下量測 main.py 的吞吐量與 p50/p99 延遲。
+#
+#   python bench.py
+#   python bench.py --sizes 1000,10000 --chats 50 --sheet-latency 0.2 --cloud-latency 0.3 --tg-latency 0.05
+import argparse, asyncio, csv, io, os, random, statistics, tempfile, time, zipfile
+
+# main.py 在 import 時會讀取這些環境變數，給假值即可 (Google 連線為延遲建立，不會真的連線)
+for key in ("BOT_TOKEN", "GOOGLE_KEY", "CLOUDINARY_CLOUD_NAME", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET"):
+    os.environ.setdefault(key, "bench")
+os.environ.setdefault("CACHE_DB", os.path.join(tempfile.mkdtemp(), "bench_cache.db"))
+
+import main
+
+PREFIXES = ["PG", "JDB", "CQ9", "KA", "BNG", "電子", "棋牌", "捕魚", "真人", "體育"]
+
+# ========== 1. 假的外部服務 ==========
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+class FakeWorksheet:
+    # 行為對齊 gspread.Worksheet 用到的部分；latency 以 time.sleep 模擬 (在 I/O 執行緒池中執行)
+    # spreadsheet.get_lastUpdateTime() 在每次寫入 (含 edit() 模擬的外部修改) 後改變
+    def __init__(self, rows, latency=0.0):
+        self.values = [list(main.COLS)] + [list(r) for r in rows]
+        self.latency, self.calls, self.cells_read, self.revision = latency, 0, 0, 0
+        self.spreadsheet = self
+
+    def _hit(self, write=False):
+        self.calls += 1
+        if write: self.revision += 1
+        if self.latency: time.sleep(self.latency)
+
+    def get_lastUpdateTime(self):
+        self._hit()
+        return f"rev-{self.revision}"
+
+    def edit(self, row, col, value):
+        # 模擬有人直接在 Google Sheets 上修改
+        self.values[row - 1][col - 1] = value
+        self.revision += 1
+
+    def get_all_records(self):
+        self._hit()
+        self.cells_read += sum(map(len, self.values))
+        head = self.values[0]
+        return [dict(zip(head, r)) for r in self.values[1:]]
+
+    def acell(self, label):
+        self._hit()
+        self.cells_read += 1
+        row = int(label[1:])
+        return FakeCell(self.values[row - 1][0] if row <= len(self.values) else None)
+
+    def update_cell(self, row, col, value):
+        self._hit(write=True)
+        self.values[row - 1][col - 1] = value
+
+    def batch_update(self, data, **kwargs):
+        self._hit(write=True)
+        for d in data:
+            col, row = ord(d["range"][0]) - 64, int(d["range"][1:])
+            self.values[row - 1][col - 1] = d["values"][0][0]
+
+    def append_rows(self, rows, **kwargs):
+        self._hit(write=True)
+        start = len(self.values) + 1
+        self.values += [list(r) for r in rows]
+        return {"updates": {"updatedRange": f"Sheet1!A{start}:C{len(self.values)}"}}
+
+    def delete_rows(self, row):
+        self._hit(write=True)
+        del self.values[row - 1]
+
+class FakeCloudinary:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def _resource(self, public_id):
+        if self.latency: time.sleep(self.latency)
+        return {"public_id": public_id, "secure_url": f"https://res.cloudinary.com/bench/image/upload/{public_id}"}
+
+    def upload(self, data, public_id=None, folder=None, **kwargs):
+        return self._resource(f"{folder}/{public_id}" if folder else public_id)
+
+    def rename(self, old, new, **kwargs):
+        return self._resource(new)
+
+    def destroy(self, public_id, **kwargs):
+        return self._resource(public_id)
+
+    def update(self, public_id, **kwargs):
+        return self._resource(public_id)
+
+    def resource(self, public_id, **kwargs):
+        return self._resource(public_id)
+
+# ========== 2. 假的 Telegram 物件 ==========
+class FakePhotoSize:
+    def __init__(self, file_id, size=200_000, width=1280, height=960):
+        self.file_id, self.file_size, self.width, self.height = file_id, size, width, height
+
+class FakeSent:
+    def __init__(self, photo=None):
+        self.photo = [FakePhotoSize(photo)] if photo else []
+
+class FakeDocument:
+    def __init__(self, file_id, file_name, size):
+        self.file_id, self.file_name, self.file_size = file_id, file_name, size
+
+class FakeMessage:
+    def __init__(self, chat_id, text=None, photo=None, document=None, latency=0.0):
+        self.chat_id, self.chat = chat_id, FakeChat(chat_id)
+        self.text, self.message_id = text, random.randrange(1 << 30)
+        # 與 Telegram 相同，同一張照片提供由小到大的多種尺寸
+        self.photo = [FakePhotoSize(f"{photo}-{w}", w * w * 3 // 16, w, w * 3 // 4) for w in (90, 320, 800, 1280, 2560)] if photo else []
+        self.document = document
+        self.latency, self.replies, self.last_markup = latency, [], None
+
+    async def _send(self, kind, payload, **kwargs):
+        if self.latency: await asyncio.sleep(self.latency)
+        self.replies.append((kind, payload))
+        self.last_markup = kwargs.get("reply_markup") or self.last_markup
+        return FakeSent(f"tg-{hash(payload) & 0xffffff}" if kind == "photo" else None)
+
+    async def reply_text(self, text, **kwargs):
+        return await self._send("text", text, **kwargs)
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        return await self._send("photo", photo, **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return await self._send("document", document, **kwargs)
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeCallbackQuery:
+    def __init__(self, chat_id, data, latency=0.0):
+        self.data, self.message = data, FakeMessage(chat_id, latency=latency)
+        self.latency = latency
+
+    async def answer(self, *args, **kwargs):
+        if self.latency: await asyncio.sleep(self.latency)
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.message.reply_text(text, **kwargs)
+
+class FakeUpdate:
+    def __init__(self, chat_id, message=None, callback_query=None):
+        self.effective_chat, self.message, self.callback_query = FakeChat(chat_id), message, callback_query
+
+class FakeFile:
+    def __init__(self, data=None):
+        self.data = data
+
+    async def download_as_bytearray(self):
+        return bytearray(self.data if self.data is not None else b"\xff\xd8" + os.urandom(64 * 1024))
+
+class FakeBot:
+    # files: 上傳過的文件 (file_id -> bytes)；其他 file_id 視為照片，回傳隨機內容
+    def __init__(self, latency=0.0):
+        self.latency, self.files = latency, {}
+
+    async def get_file(self, file_id):
+        if self.latency: await asyncio.sleep(self.latency)
+        return FakeFile(self.files.get(file_id))
+
+class FakeContext:
+    def __init__(self, bot, args=()):
+        self.bot, self.args = bot, list(args)
+
+# ========== 3. 量測工具 ==========
+def make_rows(n):
+    return [[f"{PREFIXES[i % len(PREFIXES)]}{i:06d}", f"https://res.cloudinary.com/bench/image/upload/supplier_bot/{i}", f"備註 {i}"]
+            for i in range(n)]
+
+def make_import_zip(prefix, n):
+    # CSV + n 張圖片 (以 image 欄位對應檔名)
+    buf, text = io.BytesIO(), io.StringIO()
+    out = csv.writer(text)
+    out.writerow(["supplier", "info", "image"])
+    out.writerows([f"{prefix}{i:05d}", f"匯入備註 {i}", f"img/{i}.jpg"] for i in range(n))
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("suppliers.csv", text.getvalue().encode("utf-8-sig"))
+        for i in range(n): zf.writestr(f"img/{i}.jpg", b"\xff\xd8" + os.urandom(32 * 1024))
+    return buf.getvalue()
+
+def result_callback(msg):
+    # 取多筆結果按鈕中的第一個「查看」按鈕
+    for row in getattr(msg.last_markup, "inline_keyboard", ()):
+        for button in row:
+            if str(button.callback_data).startswith("v_"): return button.callback_data
+    return None
+
+def report(name, size, samples, wall):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<18}{size:>8}{len(samples):>8}{len(samples) / wall:>12.1f}"
+          f"{statistics.median(samples) * 1000:>10.3f}{p99 * 1000:>10.3f}")
+
+async def run_chats(chats, per_chat, make_call):
+    # 每個聊天室依序送出 per_chat 個請求，各聊天室之間同時進行
+    samples = []
+    async def one_chat(chat_id):
+        for i in range(per_chat):
+            start = time.perf_counter()
+            await make_call(chat_id, i)
+            samples.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(one_chat(1000 + c) for c in range(chats)))
+    return samples, time.perf_counter() - start
+
+# ========== 4. 測試情境 ==========
+async def bench_size(size, args, cloud):
+    rows = make_rows(size)
+    main.sheet = FakeWorksheet(rows, args.sheet_latency)
+    bot = FakeBot(args.tg_latency)
+    names = [r[0] for r in rows]
+
+    # refresh_cache：整張表下載 + 重建索引 + 寫入快照
+    samples = []
+    start = time.perf_counter()
+    for _ in range(3):
+        t = time.perf_counter(); await main.refresh_cache_async(); samples.append(time.perf_counter() - t)
+    report("refresh_cache", size, samples, time.perf_counter() - start)
+
+    # find_in_cache：精確查詢
+    keys = [random.choice(names) for _ in range(args.lookups)]
+    samples = []
+    start = time.perf_counter()
+    for k in keys:
+        t = time.perf_counter(); main.find_in_cache(k); samples.append(time.perf_counter() - t)
+    report("find_in_cache", size, samples, time.perf_counter() - start)
+
+    # perform_search：完全相符 / 開頭 / 子字串 混合關鍵字
+    def keyword():
+        n = random.choice(names)
+        return random.choice([n, n[:len(n) - 2], n[2:], n[-4:]])
+    async def search(chat_id, i):
+        await main.perform_search(FakeUpdate(chat_id, FakeMessage(chat_id, keyword(), latency=args.tg_latency)), keyword())
+    samples, wall = await run_chats(args.chats, args.per_chat, search)
+    report("perform_search", size, samples, wall)
+
+    # handle_all：一般文字訊息 (搜尋) 經完整 handler 路徑
+    async def text(chat_id, i):
+        msg = FakeMessage(chat_id, keyword(), latency=args.tg_latency)
+        await main.handle_all(FakeUpdate(chat_id, msg), FakeContext(bot))
+    samples, wall = await run_chats(args.chats, args.per_chat, text)
+    report("handle_all search", size, samples, wall)
+
+    # callback_handler：點選多筆結果中的某一筆
+    async def pick(chat_id, i):
+        msg = FakeMessage(chat_id, random.choice(PREFIXES), latency=args.tg_latency)
+        await main.perform_search(FakeUpdate(chat_id, msg), msg.text)
+        data = result_callback(msg) or f"v_{random.choice(names)}"
+        query = FakeCallbackQuery(chat_id, data, latency=args.tg_latency)
+        await main.callback_handler(FakeUpdate(chat_id, callback_query=query), FakeContext(bot))
+    samples, wall = await run_chats(args.chats, max(1, args.per_chat // 4), pick)
+    report("callback_handler", size, samples, wall)
+
+    # handle_all 管理流程：新增 (圖片 -> 名稱 -> 備註) 與修改備註，各聊天室同時進行
+    async def admin(chat_id, i):
+        ctx = FakeContext(bot)
+        main.user_state[chat_id] = {"mode": "add"}
+        for m in (FakeMessage(chat_id, photo=f"p{chat_id}{i}", latency=args.tg_latency),
+                  FakeMessage(chat_id, f"bench-{chat_id}-{i}", latency=args.tg_latency),
+                  FakeMessage(chat_id, "新增備註", latency=args.tg_latency)):
+            await main.handle_all(FakeUpdate(chat_id, m), ctx)
+        main.user_state[chat_id] = {"mode": "ei_step1"}
+        for m in (FakeMessage(chat_id, random.choice(names), latency=args.tg_latency),
+                  FakeMessage(chat_id, "修改備註", latency=args.tg_latency)):
+            await main.handle_all(FakeUpdate(chat_id, m), ctx)
+    samples, wall = await run_chats(args.chats, args.admin_per_chat, admin)
+    report("handle_all admin", size, samples, wall)
+    await main.sheet_writer.flush()
+
+    # /import：ZIP (CSV + 圖片) 批次新增，圖片同時上傳、一次 append_rows；/export 匯出 CSV
+    samples = []
+    start = time.perf_counter()
+    for i in range(args.imports):
+        chat_id, before = 9000 + i, len(main.local_cache)
+        data = make_import_zip(f"import-{size}-{i}-", args.import_rows)
+        bot.files[f"doc{i}"] = data
+        main.user_state[chat_id] = {"mode": "import"}
+        msg = FakeMessage(chat_id, document=FakeDocument(f"doc{i}", "suppliers.zip", len(data)), latency=args.tg_latency)
+        t = time.perf_counter(); await main.handle_all(FakeUpdate(chat_id, msg), FakeContext(bot)); samples.append(time.perf_counter() - t)
+        assert len(main.local_cache) == before + args.import_rows, msg.replies[-1]
+    report(f"import x{args.import_rows}", size, samples, time.perf_counter() - start)
+    samples = []
+    start = time.perf_counter()
+    for _ in range(3):
+        msg = FakeMessage(1, "/export", latency=args.tg_latency)
+        t = time.perf_counter(); await main.export_cmd(FakeUpdate(1, msg), FakeContext(bot)); samples.append(time.perf_counter() - t)
+    report("export_cmd", size, samples, time.perf_counter() - start)
+
+    # 變更偵測：沒變動時只查修改時間；外部改了幾列後，比對並只更新那幾列；
+    # 機器人自己寫入 (update_supplier) 後不應重抓整張表
+    sheet = main.sheet
+    await main.sync_sheet_changes()
+    for label, edits, own in (("sheet_poll idle", 0, False), ("sheet_poll edited", 5, False), ("sheet_poll own", 5, True)):
+        samples, cells = [], 0
+        start = time.perf_counter()
+        for _ in range(args.polls):
+            picks = random.sample(range(2, len(sheet.values) + 1), edits)
+            for row in picks:
+                if own: await main.update_supplier(sheet.values[row - 1][0], [(3, f"機器人修改 {random.random()}")])
+                else: sheet.edit(row, 3, f"外部修改 {random.random()}")
+            before = sheet.cells_read
+            t = time.perf_counter(); await main.sync_sheet_changes(); samples.append(time.perf_counter() - t)
+            cells += sheet.cells_read - before
+            for row in picks: assert main.find_in_cache(sheet.values[row - 1][0])[1]["info"] == sheet.values[row - 1][2]
+        report(label, size, samples, time.perf_counter() - start)
+        print(f"{'':<18}cells read per poll: {cells / args.polls:.0f}")
+
+async def run(args):
+    cloud = FakeCloudinary(args.cloud_latency)
+    main.CLOUD_OPS.update(upload=cloud.upload, rename=cloud.rename, destroy=cloud.destroy, update=cloud.update,
+                          resource=cloud.resource)
+    print(f"{'scenario':<18}{'rows':>8}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for size in args.sizes:
+        await bench_size(size, args, cloud)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline benchmark for the supplier bot")
+    p.add_argument("--sizes", default="1000,10000,100000", type=lambda s: [int(x) for x in s.split(",")])
+    p.add_argument("--chats", default=50, type=int, help="concurrent chats")
+    p.add_argument("--per-chat", default=40, type=int, help="searches per chat")
+    p.add_argument("--admin-per-chat", default=2, type=int, help="add + edit flows per chat")
+    p.add_argument("--lookups", default=20000, type=int, help="find_in_cache calls")
+    p.add_argument("--polls", default=5, type=int, help="change-detection polls per case")
+    p.add_argument("--imports", default=2, type=int, help="/import runs")
+    p.add_argument("--import-rows", default=300, type=int, help="suppliers (with images) per /import")
+    p.add_argument("--sheet-latency", default=0.0, type=float, help="seconds per simulated Sheets call")
+    p.add_argument("--cloud-latency", default=0.0, type=float, help="seconds per simulated Cloudinary call")
+    p.add_argument("--tg-latency", default=0.0, type=float, help="seconds per simulated Telegram call")
+    p.add_argument("--seed", default=1, type=int)
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
@@ -1,16 +1,16 @@
 import asyncio
-import nest_asyncio
-nest_asyncio.apply()
-
-import os, json, gspread, cloudinary, cloudinary.uploader
+import os, json, time, sqlite3, functools, gspread, cloudinary, cloudinary.uploader
 import cloudinary.api  
+from concurrent.futures import ThreadPoolExecutor
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultPhoto, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.error import BadRequest
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, BaseUpdateProcessor, InlineQueryHandler
+from telegram.request import HTTPXRequest
 
-# 🔧 新增（防 Render / Railway 休眠）
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading, re, bisect, heapq, random, signal, contextlib, secrets, csv, io, zipfile
+from collections import defaultdict, OrderedDict
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # ========== 1. 初始化與環境變數 ==========
@@ -24,63 +24,845 @@ cloudinary.config(
     secure=True
 )
 
+# Google 連線延後到第一次使用時才建立 (啟動時與 Telegram 初始化並行)，不在 import 時卡住
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(GOOGLE_KEY_JSON), scope)
-client = gspread.authorize(creds)
-sheet = client.open("telegram-supplier-bot").sheet1
+sheet, google_lock = None, threading.Lock()
+
+def get_sheet():
+    global sheet
+    if sheet is None:
+        with google_lock:
+            if sheet is None:
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(GOOGLE_KEY_JSON), scope)
+                sheet = gspread.authorize(creds).open("telegram-supplier-bot").sheet1
+    return sheet
+
+local_cache = []
+
+# ========== 1-1. 監控指標 (GET /metrics，Prometheus 文字格式) ==========
+# 只做整數累加與 bisect，常態開啟也幾乎沒有成本
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts, self.sum = [0] * (len(LATENCY_BUCKETS) + 1), 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+# key 為 label tuple，例: (("service", "sheets"), ("op", "append_rows"))
+handler_seconds, handler_errors = defaultdict(Histogram), defaultdict(int)
+call_seconds, call_errors = defaultdict(Histogram), defaultdict(int)
+refresh_seconds, refresh_errors = Histogram(), [0]
+refresh_rows, cache_synced_at = [0], [None]
+sheet_polls = defaultdict(int)  # 變更偵測結果 (unchanged / changed / retry / error) -> 次數
+
+@contextlib.contextmanager
+def timed(hist, errors, key):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors[key] += 1
+        raise
+    finally:
+        hist[key].observe(time.perf_counter() - start)
+
+def timed_handler(fn):
+    # 包裝 handler 記錄處理時間，名稱沿用函式名 (handle_all、callback_handler、*_cmd)
+    key = (("handler", fn.__name__),)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with timed(handler_seconds, handler_errors, key):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+class TimedRequest(HTTPXRequest):
+    # 記錄每個 Telegram Bot API 呼叫 (sendPhoto、answerCallbackQuery...) 的延遲
+    async def do_request(self, url, method, *args, **kwargs):
+        with timed(call_seconds, call_errors, (("service", "telegram"), ("op", url.rsplit("/", 1)[-1]))):
+            return await super().do_request(url, method, *args, **kwargs)
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+def _histogram_lines(name, doc, series):
+    lines = [f"# HELP {name} {doc}", f"# TYPE {name} histogram"]
+    for key, h in series.items():
+        total = 0
+        for le, c in zip(LATENCY_BUCKETS + ("+Inf",), h.counts):
+            total += c
+            lines.append(f"{name}_bucket{_labels(key, [('le', le)])} {total}")
+        lines += [f"{name}_sum{_labels(key)} {h.sum}", f"{name}_count{_labels(key)} {total}"]
+    return lines
+
+def _counter_lines(name, doc, series, kind="counter"):
+    return [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"] + [f"{name}{_labels(k)} {v}" for k, v in series.items()]
+
+def render_metrics():
+    age = time.time() - cache_synced_at[0] if cache_synced_at[0] else "NaN"
+    lines = (
+        _histogram_lines("bot_handler_seconds", "Handler latency", dict(handler_seconds))
+        + _counter_lines("bot_handler_errors_total", "Handler exceptions", dict(handler_errors))
+        + _histogram_lines("bot_external_call_seconds", "Sheets / Cloudinary / Telegram call latency", dict(call_seconds))
+        + _counter_lines("bot_external_call_errors_total", "Failed external calls", dict(call_errors))
+        + _histogram_lines("bot_cache_refresh_seconds", "Full sheet refresh duration", {(): refresh_seconds})
+        + _counter_lines("bot_cache_refresh_errors_total", "Failed full sheet refreshes", {(): refresh_errors[0]})
+        + _counter_lines("bot_cache_refresh_rows", "Rows loaded by the last full refresh", {(): refresh_rows[0]}, "gauge")
+        + _counter_lines("bot_sheet_polls_total", "Sheet change-detection polls by result",
+                         {(("result", k),): v for k, v in sheet_polls.items()})
+        + _counter_lines("bot_cache_rows", "Suppliers in the in-memory cache", {(): len(search_index["rows"])}, "gauge")
+        + _counter_lines("bot_cache_age_seconds", "Seconds since the cache was last synced", {(): age}, "gauge")
+        + _counter_lines("bot_active_flows", "Chats with an in-progress admin flow", {(): len(user_state)}, "gauge")
+        + _counter_lines("bot_pending_writes", "Sheet writes waiting in the batch queue",
+                         {(): len(sheet_writer.cells) + len(sheet_writer.appends)}, "gauge")
+    )
+    return ("\n".join(lines) + "\n").encode()
+
+# ========== 2. 快取同步與搜尋索引 ==========
+# 索引結構 (整包同步時重建後一次替換；自己寫入時就地增修，只動到該筆資料)
+#   rows    : 快取資料列，依試算表順序 (與 local_cache 為同一個 list)
+#   row_no  : 每筆資料在試算表中的實際列號 (跳過空白列後仍正確)
+#   ids     : 每筆資料的固定編號，刪除其他列時不會變動
+#   recs / row_of : 編號 -> 資料列 / 列號
+#   by_name : 正規化名稱 -> 編號，用於精確查詢
+#   grams   : 1~3 字元片段 -> 編號集合，用於子字串搜尋
+GRAM_MAX = 3
+
+def norm_name(name):
+    return str(name).strip().lower()
+
+def name_grams(n):
+    return {n[i:i + size] for size in range(1, GRAM_MAX + 1) for i in range(len(n) - size + 1)}
+
+def _index_add(idx, rid, rec):
+    n = norm_name(rec.get("supplier", ""))
+    # 名稱重複時以試算表中較前面的一筆為準 (與逐列掃描的結果一致)
+    cur = idx["by_name"].get(n)
+    if cur is None or idx["row_of"][rid] < idx["row_of"][cur]: idx["by_name"][n] = rid
+    for g in name_grams(n):
+        idx["grams"].setdefault(g, set()).add(rid)
+
+def _index_remove(idx, rid, rec):
+    n = norm_name(rec.get("supplier", ""))
+    for g in name_grams(n):
+        ids = idx["grams"].get(g)
+        if ids is not None:
+            ids.discard(rid)
+            if not ids: del idx["grams"][g]
+    if idx["by_name"].get(n) == rid:
+        # 名稱重複時改指向下一筆同名資料
+        same = [i for i in idx["grams"].get(n[:GRAM_MAX], ()) if norm_name(idx["recs"][i].get("supplier", "")) == n]
+        if same: idx["by_name"][n] = min(same, key=idx["row_of"].get)
+        else: del idx["by_name"][n]
+
+def build_index(rows, row_no):
+    idx = {"rows": list(rows), "row_no": list(row_no), "ids": list(range(len(rows))),
+           "recs": dict(enumerate(rows)), "row_of": dict(enumerate(row_no)),
+           "by_name": {}, "grams": {}, "next_id": len(rows)}
+    for rid, rec in enumerate(rows):
+        _index_add(idx, rid, rec)
+    return idx
+
+search_index = build_index([], [])
+# 寫入快取的鎖與版本號：排程執行緒的整包同步與 handler 的局部更新不會互相覆蓋
+# 索引一律在鎖外建好，鎖內只比對版本號並替換，event loop 上的局部更新不會被卡住
+cache_lock, cache_version = threading.Lock(), 0
 
-user_state, local_cache = {}, []
+def swap_index(idx):
+    global local_cache, search_index, cache_version
+    search_index = idx
+    local_cache = idx["rows"]
+    cache_version += 1
+
+def sheet_rows(raw_data):
+    rows, row_no = [], []
+    # get_all_records 從第 2 列開始 (第 1 列為標題)，跳過沒有名稱的空白列
+    for i, r in enumerate(raw_data, start=2):
+        if str(r.get("supplier", "")).strip():
+            rows.append(r); row_no.append(i)
+    return rows, row_no
+
+# 試算表最後修改時間 (Drive metadata，不讀任何儲存格)；變更偵測以此判斷是否需要下載
+sheet_modified = [None]
+
+def sheet_modified_time():
+    # gspread 6 每次呼叫都向 Drive 查詢；舊的 lastUpdateTime 屬性會沿用開啟時的值，不能用來偵測變更
+    return get_sheet().spreadsheet.get_lastUpdateTime()
 
-# ========== 2. 快取同步 ==========
 def refresh_cache():
-    global local_cache
+    start = time.perf_counter()
     try:
-        raw_data = sheet.get_all_records()
-        local_cache = [r for r in raw_data if str(r.get("supplier", "")).strip()]
-        print(f"✨ 緩存同步成功：{len(local_cache)} 筆")
+        for _ in range(2):
+            seen = cache_version
+            try: modified = sheet_modified_time()
+            except Exception as e: modified = None; print(f"⚠️ 無法取得試算表修改時間: {e}")
+            raw_data = get_sheet().get_all_records()
+            rows, row_no = sheet_rows(raw_data)
+            idx = build_index(rows, row_no)
+            with cache_lock:
+                # 下載期間有局部更新，這份資料可能已過時，重抓一次
+                if seen != cache_version: continue
+                swap_index(idx)
+            sheet_modified[0] = modified
+            print(f"✨ 緩存同步成功：{len(rows)} 筆")
+            refresh_seconds.observe(time.perf_counter() - start)
+            refresh_rows[0], cache_synced_at[0] = len(rows), time.time()
+            save_snapshot(rows, row_no)
+            return
+        print("⚠️ 同步期間資料持續變動，保留目前快取")
     except Exception as e:
+        refresh_errors[0] += 1
         print(f"❌ 同步失敗: {e}")
 
+# ========== 2-0. 本機快照 (冷啟動先用快照回應，背景再跟試算表比對) ==========
+CACHE_DB = os.environ.get("CACHE_DB", "supplier_cache.db")
+
+def db_connect():
+    conn = sqlite3.connect(CACHE_DB, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS suppliers (row_no INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS photo_ids (name TEXT PRIMARY KEY, image_url TEXT, file_id TEXT)")
+    return conn
+
+def save_snapshot(rows, row_no):
+    try:
+        with db_connect() as conn:
+            conn.execute("DELETE FROM suppliers")
+            conn.executemany("INSERT INTO suppliers VALUES (?, ?)",
+                             ((n, json.dumps(r, ensure_ascii=False)) for n, r in zip(row_no, rows)))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('saved_at', ?)", (str(time.time()),))
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ 快照寫入失敗: {e}")
+
+def load_snapshot():
+    try:
+        conn = db_connect()
+        data = conn.execute("SELECT row_no, data FROM suppliers ORDER BY row_no").fetchall()
+        ids = conn.execute("SELECT name, image_url, file_id FROM photo_ids").fetchall()
+        saved_at = conn.execute("SELECT value FROM meta WHERE key = 'saved_at'").fetchone()
+        conn.close()
+    except Exception as e:
+        return print(f"⚠️ 快照讀取失敗: {e}")
+    photo_ids.update((name, (url, fid)) for name, url, fid in ids)
+    if not data: return
+    idx = build_index([json.loads(d) for _, d in data], [n for n, _ in data])
+    with cache_lock:
+        swap_index(idx)
+    if saved_at and not cache_synced_at[0]: cache_synced_at[0] = float(saved_at[0])
+    print(f"📦 已載入本機快照：{len(data)} 筆")
+
+# Telegram file_id 快取：正規化名稱 -> (圖片網址, file_id)
+# 同一張圖第二次之後直接用 file_id 傳送，Telegram 不必再到 Cloudinary 抓圖
+photo_ids = {}
+
+def save_photo_id(name, url, file_id):
+    try:
+        with db_connect() as conn:
+            if file_id: conn.execute("INSERT OR REPLACE INTO photo_ids VALUES (?, ?, ?)", (name, url, file_id))
+            else: conn.execute("DELETE FROM photo_ids WHERE name = ?", (name,))
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ file_id 寫入失敗: {e}")
+
+def forget_photo_id(name):
+    # 換圖、改名、刪除後舊的 file_id 不能再用
+    if photo_ids.pop(norm_name(name), None):
+        io_pool.submit(save_photo_id, norm_name(name), None, None)
+
 def find_in_cache(name):
-    n = str(name).strip().lower()
-    for i, row in enumerate(local_cache, start=2):
-        if str(row.get("supplier", "")).strip().lower() == n:
-            return i, row
-    return None, None
-
-refresh_cache()
-
-# ========== 3. Render 健康檢查 (整合 do_HEAD 版) ==========
-def start_health_server():
-    class Handler(BaseHTTPRequestHandler):
-        # 處理瀏覽器或 UptimeRobot 的 GET 請求
-        def do_GET(self):
-            if self.path in ("/", "/health"):
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"OK")
+    idx = search_index
+    rid = idx["by_name"].get(norm_name(name))
+    if rid is None:
+        return None, None
+    return idx["row_of"][rid], idx["recs"][rid]
+
+def rank_matches(idx, q, rids):
+    # 回傳尚未排序的 (排序鍵, 列號, id)；排序：完全相符 > 開頭相符 > 包含，同級則依試算表順序
+    ranked = []
+    for rid in rids:
+        n = norm_name(idx["recs"][rid].get("supplier", ""))
+        if q not in n:
+            continue
+        rank = 0 if n == q else 1 if n.startswith(q) else 2
+        ranked.append((rank, idx["row_of"][rid], rid))
+    return ranked
+
+def search_candidates(idx, q):
+    # 由 n-gram 索引取出名稱可能包含 q 的 id (q 已正規化)
+    if not q:
+        return ()
+    if len(q) <= GRAM_MAX:
+        return idx["grams"].get(q, ())
+    parts = [idx["grams"].get(q[i:i + GRAM_MAX]) for i in range(len(q) - GRAM_MAX + 1)]
+    if not all(parts):
+        return ()
+    return set.intersection(*sorted(parts, key=len))
+
+def search_cache(kw, limit=None):
+    # 回傳 (排序後的結果, 符合總數)；只需要前 limit 筆時以 heapq.nsmallest 部分排序，不必排序全部符合的列
+    idx, q = search_index, norm_name(kw)
+    ranked = rank_matches(idx, q, search_candidates(idx, q))
+    top = sorted(ranked) if limit is None or limit >= len(ranked) else heapq.nsmallest(limit, ranked)
+    return [idx["recs"][rid] for _, _, rid in top], len(ranked)
+
+# ========== 2-1. 非同步 I/O (Sheets / Cloudinary 移出 event loop) ==========
+# gspread 與 cloudinary 皆為同步呼叫，直接在 handler 裡執行會卡住所有聊天室的搜尋。
+# 統一丟到固定大小的執行緒池，並加上逾時；逾時只會放棄等待，背景執行緒仍會跑完該次呼叫。
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 4))
+IO_TIMEOUT = float(os.environ.get("IO_TIMEOUT", 30))
+REFRESH_TIMEOUT = float(os.environ.get("REFRESH_TIMEOUT", 60))
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+CLOUD_OPS = {
+    "upload": cloudinary.uploader.upload,
+    "rename": cloudinary.uploader.rename,
+    "destroy": cloudinary.uploader.destroy,
+    "update": cloudinary.api.update,
+    "resource": cloudinary.api.resource,
+}
+
+async def run_io(fn, *args, timeout=IO_TIMEOUT, executor=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(executor or io_pool, functools.partial(fn, *args, **kwargs)), timeout)
+
+def _sheet_call(op, *args, **kwargs):
+    return getattr(get_sheet(), op)(*args, **kwargs)
+
+async def sheet_io(op, *args, **kwargs):
+    with timed(call_seconds, call_errors, (("service", "sheets"), ("op", op))):
+        return await run_io(_sheet_call, op, *args, **kwargs)
+
+async def cloud_io(op, *args, executor=None, **kwargs):
+    with timed(call_seconds, call_errors, (("service", "cloudinary"), ("op", op))):
+        return await run_io(CLOUD_OPS[op], *args, executor=executor, **kwargs)
+
+async def refresh_cache_async():
+    await run_io(refresh_cache, timeout=REFRESH_TIMEOUT)
+
+# 圖片尺寸：上傳時限制最長邊 (Cloudinary incoming transformation，只存縮小後的版本)；
+# 顯示時依用途請 Cloudinary 產生對應尺寸 (q_auto 自動畫質；Telegram 以網址傳圖與縮圖只接受 JPEG)，不再傳原圖
+IMAGE_MAX_DIM = int(os.environ.get("IMAGE_MAX_DIM", 1600))
+UPLOAD_OPTS = {"transformation": [{"width": IMAGE_MAX_DIM, "height": IMAGE_MAX_DIM, "crop": "limit", "quality": "auto:good"}],
+               "format": "jpg"}
+CARD_MAX_DIM = int(os.environ.get("CARD_MAX_DIM", 1024))  # 單筆結果的圖片卡
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", 160))       # inline 結果的縮圖
+RENDITIONS = {
+    "card": f"c_limit,w_{CARD_MAX_DIM},h_{CARD_MAX_DIM},q_auto,f_jpg",
+    "thumb": f"c_fill,w_{THUMB_SIZE},h_{THUMB_SIZE},q_auto,f_jpg",
+}
+
+def image_rendition(url, kind):
+    # 只處理 Cloudinary 網址且尚未帶轉換參數的；其他網址原樣回傳
+    if "res.cloudinary.com/" not in url or "/image/upload/" not in url: return url
+    head, tail = url.split("/image/upload/", 1)
+    if re.match(r"[a-z]{1,2}_[^/]+/", tail): return url
+    return f"{head}/image/upload/{RENDITIONS[kind]}/{tail}"
+
+# ========== 2-2. 寫入後直接更新快取 (write-through) ==========
+# 自己寫入成功後直接改 local_cache，不再每次重新下載整張表；
+# 只有在發現試算表被外部改動 (列號對不上) 時才整包重新同步。
+COLS = ("supplier", "image_url", "info")  # 試算表 A / B / C 欄
+
+# 以下皆在 event loop 執行緒就地修改索引，不重建整份索引；搜尋函式中沒有 await，不會讀到改到一半的狀態
+def cache_append(row, values):
+    global cache_version
+    with cache_lock:
+        idx, rec = search_index, dict(zip(COLS, values))
+        rid = idx["next_id"]; idx["next_id"] += 1
+        idx["rows"].append(rec); idx["row_no"].append(row); idx["ids"].append(rid)
+        idx["recs"][rid], idx["row_of"][rid] = rec, row
+        _index_add(idx, rid, rec)
+        cache_version += 1
+
+def cache_update(row, col, value):
+    global cache_version
+    with cache_lock:
+        idx = search_index
+        pos = bisect.bisect_left(idx["row_no"], row)
+        if pos == len(idx["row_no"]) or idx["row_no"][pos] != row: return
+        rid = idx["ids"][pos]
+        old = idx["recs"][rid]
+        rec = {**old, COLS[col - 1]: value}
+        if col == 1: _index_remove(idx, rid, old)
+        idx["rows"][pos] = idx["recs"][rid] = rec
+        if col == 1: _index_add(idx, rid, rec)
+        cache_version += 1
+
+def cache_delete(row):
+    global cache_version
+    with cache_lock:
+        idx = search_index
+        pos = bisect.bisect_left(idx["row_no"], row)
+        if pos < len(idx["row_no"]) and idx["row_no"][pos] == row:
+            rid = idx["ids"][pos]
+            del idx["rows"][pos], idx["row_no"][pos], idx["ids"][pos]
+            idx["row_of"].pop(rid)
+            _index_remove(idx, rid, idx["recs"].pop(rid))
+        # 被刪除列之後的資料列號全部往前移一列 (刪到空白列時也一樣要位移)
+        row_no, row_of = idx["row_no"], idx["row_of"]
+        for i in range(pos, len(row_no)):
+            row_no[i] -= 1
+            row_of[idx["ids"][i]] -= 1
+        cache_version += 1
+
+async def locate_row(name):
+    # 寫入前只讀一格確認列號仍對應該遊戲商，對不上才整包同步後重新定位
+    idx = find_in_cache(name)[0]
+    if idx:
+        try:
+            cell = await sheet_io("acell", f"A{idx}")
+            if norm_name(cell.value or "") == norm_name(name): return idx
+        except Exception as e:
+            print(f"⚠️ 列號檢查失敗: {e}")
+    await refresh_cache_async()
+    return find_in_cache(name)[0]
+
+async def apply_append(rows, res):
+    # append_rows 回傳 updatedRange (例: Sheet1!A57:C59)，新列若不是緊接在快取最後一列之後，代表表格已變動
+    m = re.search(r"![A-Z]+(\d+)", (res or {}).get("updates", {}).get("updatedRange", ""))
+    row_no = search_index["row_no"]
+    start = int(m.group(1)) if m else None
+    if start is not None and start == (row_no[-1] + 1 if row_no else 2):
+        for i, values in enumerate(rows):
+            cache_append(start + i, values)
+    else:
+        await refresh_cache_async()
+    return start
+
+# ========== 2-3. 批次寫入佇列 (write-behind) ==========
+# 儲存格更新與新增列先排進佇列：同一格只保留最後一次的值，累積到筆數上限或等待時間到才
+# 合併成一次 batch_update / append_rows。遇到 429 或 5xx 以指數退避重試。
+# handler await 取得的結果代表資料已寫入試算表，且快取已同步更新。
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 50))
+WRITE_FLUSH_DELAY = float(os.environ.get("WRITE_FLUSH_DELAY", 0.5))
+WRITE_MAX_RETRY = int(os.environ.get("WRITE_MAX_RETRY", 5))
+WRITE_BACKOFF_MAX = 64
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+async def sheet_retry(op, *args, idempotent=True, **kwargs):
+    # 非冪等操作 (新增、刪除列) 遇到 5xx 時可能其實已寫入，只在 429 (確定未執行) 時重試
+    for attempt in range(WRITE_MAX_RETRY + 1):
+        try:
+            return await sheet_io(op, *args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if attempt == WRITE_MAX_RETRY or status not in (RETRY_STATUS if idempotent else {429}): raise
+            delay = min(WRITE_BACKOFF_MAX, 2 ** attempt) + random.random()
+            print(f"⏳ Sheets {op} 回應 {status}，{delay:.1f} 秒後重試")
+            await asyncio.sleep(delay)
+
+async def probe_modified():
+    # 失敗時回傳 None，只會讓下一輪變更偵測照常下載，不影響寫入
+    try:
+        with timed(call_seconds, call_errors, (("service", "sheets"), ("op", "modified_time"))):
+            return await run_io(sheet_modified_time)
+    except Exception as e:
+        print(f"⚠️ 無法取得試算表修改時間: {e}")
+        return None
+
+def write_mark():
+    # (上次同步時的修改時間, 寫入前查詢修改時間的 task)；在寫入前盡早取得，查詢與其他步驟同時進行
+    return sheet_modified[0], asyncio.ensure_future(probe_modified())
+
+def settle(waiters, result=None, error=None):
+    for fut in waiters:
+        if fut.done(): continue
+        if error: fut.set_exception(error)
+        else: fut.set_result(result)
+
+
+class SheetWriter:
+    def __init__(self):
+        # 儲存格更新與新增列的確認分開記錄，其中一種寫入失敗不會連帶讓另一種的呼叫端失敗
+        self.cells, self.appends, self.cell_waiters, self.append_waiters = {}, [], [], []
+        self.lock, self.timer, self.mark = asyncio.Lock(), None, None
+
+    async def _own_write(self, mark, write):
+        # 自己的寫入也會改動試算表修改時間。寫入前查到的修改時間仍等於上次同步的值 (期間沒有外部修改) 時，
+        # 寫入後把基準推進到新的修改時間，下一輪變更偵測就不會為了自己的寫入重抓整張表。
+        # 寫入前就已有外部修改則不推進；只有兩次查詢之間極短的外部修改會被略過，由 6 小時整包同步補上。
+        # 寫入前的查詢由呼叫端提早送出 (通常已完成)；寫入後的查詢在背景進行，不延後回覆
+        synced, before = mark
+        clean = synced is not None and await before == synced
+        res = await write
+        if clean: asyncio.create_task(self._advance(synced))
+        return res
+
+    async def _advance(self, synced):
+        after = await probe_modified()
+        if after is not None and sheet_modified[0] == synced: sheet_modified[0] = after
+
+    def _enqueue(self, waiters):
+        fut = asyncio.get_running_loop().create_future()
+        waiters.append(fut)
+        # 批次的第一筆就先查寫入前的修改時間，等待合併的期間查詢通常已完成
+        if self.mark is None: self.mark = write_mark()
+        if len(self.cells) + len(self.appends) >= WRITE_BATCH_SIZE:
+            asyncio.create_task(self.flush())
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(WRITE_FLUSH_DELAY, lambda: asyncio.create_task(self.flush()))
+        return fut
+
+    # update_cell / append_row 立即排入佇列並回傳可 await 的確認，
+    # 呼叫端可以先放開 sheet_lock 再等待寫入完成
+    def update_cell(self, row, col, value):
+        self.cells[(row, col)] = value
+        return self._enqueue(self.cell_waiters)
+
+    def append_row(self, values):
+        # 確認結果為新列的列號
+        self.appends.append(list(values))
+        pos, ack = len(self.appends) - 1, self._enqueue(self.append_waiters)
+        async def row_of():
+            start = await ack
+            return start + pos if start else None
+        return asyncio.ensure_future(row_of())
+
+    async def delete_row(self, row, mark=None):
+        # 刪除會讓後面的列號位移，先把佇列內的更新寫完再刪；mark 為定位列號前以 write_mark() 取得
+        mark = mark or write_mark()
+        async with self.lock:
+            await self._flush_locked()
+            await self._own_write(mark, sheet_retry("delete_rows", row, idempotent=False))
+            cache_delete(row)
+
+    async def append_rows(self, rows):
+        # 大量新增 (/import)：先把佇列寫完，再以單一 append_rows 寫入，回傳第一筆新列的列號
+        # 寫入前的查詢與等鎖、寫完佇列同時進行
+        mark = write_mark()
+        async with self.lock:
+            await self._flush_locked()
+            return await apply_append(rows, await self._own_write(mark, sheet_retry("append_rows", rows, idempotent=False)))
+
+    async def flush(self):
+        async with self.lock:
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        if self.timer: self.timer.cancel(); self.timer = None
+        cells, appends, mark = self.cells, self.appends, self.mark
+        cell_waiters, append_waiters = self.cell_waiters, self.append_waiters
+        self.cells, self.appends, self.cell_waiters, self.append_waiters, self.mark = {}, [], [], [], None
+        if not cell_waiters and not append_waiters: return
+        try:
+            await self._own_write(mark, self._write_batch(cells, cell_waiters, appends, append_waiters))
+        except Exception:
+            pass  # 已在 _write_batch 記錄並通知各呼叫端
+
+    async def _write_batch(self, cells, cell_waiters, appends, append_waiters):
+        # 儲存格更新成功就先回覆編輯的呼叫端，不必等新增列；任一部分失敗在最後拋出，讓 _own_write 不推進修改時間
+        failed = None
+        if cells:
+            try:
+                data = [{"range": rowcol_to_a1(r, c), "values": [[v]]} for (r, c), v in cells.items()]
+                await sheet_retry("batch_update", data, value_input_option="USER_ENTERED")
+                for (r, c), v in cells.items(): cache_update(r, c, v)
+            except Exception as e:
+                print(f"❌ 批次更新失敗 ({len(cells)} 格): {e}")
+                settle(cell_waiters, error=e)
+                failed = e
             else:
-                self.send_response(404)
-                self.end_headers()
-
-        # 新增：處理 UptimeRobot 預設的 HEAD 請求
-        # 這是讓 UptimeRobot 變綠燈 (Up) 的關鍵！
-        def do_HEAD(self):
-            if self.path in ("/", "/health"):
-                self.send_response(200)
-                self.end_headers()
+                settle(cell_waiters)
+        if appends:
+            try:
+                start = await apply_append(appends, await sheet_retry("append_rows", appends, idempotent=False))
+            except Exception as e:
+                print(f"❌ 批次新增失敗 ({len(appends)} 列): {e}")
+                settle(append_waiters, error=e)
+                failed = e
             else:
-                self.send_response(404)
-                self.end_headers()
-    
-    # 取得 Render 分配的 Port，預設為 10000
-    port = int(os.environ.get("PORT", 10000))
-    server = HTTPServer(("0.0.0.0", port), Handler)
-    print(f"🌐 健康檢查伺服器啟動於 Port: {port} (支援 GET/HEAD)")
-    server.serve_forever()
+                settle(append_waiters, start)
+        if failed: raise failed
+
+sheet_writer = SheetWriter()
+
+# 列號鎖：不同聊天室同時處理時，從「定位列號」到「排入寫入佇列」(刪除則到刪除完成) 之間持有，
+# 其他聊天室的刪除不會讓已定位的列號位移；搜尋只讀快取，不需要這把鎖
+sheet_lock = asyncio.Lock()
+
+async def update_supplier(name, cells):
+    # cells: [(欄位, 新值)]；找不到該遊戲商時回傳 False
+    async with sheet_lock:
+        idx = await locate_row(name)
+        if not idx: return False
+        acks = [sheet_writer.update_cell(idx, c, v) for c, v in cells]
+    await asyncio.gather(*acks)
+    return True
+
+async def delete_supplier(name):
+    async with sheet_lock:
+        # 寫入前的修改時間查詢與定位列號同時進行
+        mark = write_mark()
+        idx = await locate_row(name)
+        if not idx:
+            mark[1].cancel(); return False
+        await sheet_writer.delete_row(idx, mark)
+    forget_photo_id(name)
+    return True
+
+# 新增中的名稱 (正規化後)：從列號鎖內確認名稱未被使用起，到寫入完成、快取已有該列為止。
+# 不同聊天室同時 /add 或 /import 同一個名稱時，只有先佔用的一方會寫入試算表
+adding_names = set()
+
+async def claim_names(names):
+    # 回傳佔用成功的名稱；已存在、正在新增或清單內重複的名稱不會回傳。寫入結束後以 release_names 釋放
+    async with sheet_lock:
+        free, keys = [], set()
+        for n in names:
+            k = norm_name(n)
+            if k in adding_names or k in keys or find_in_cache(n)[0]: continue
+            keys.add(k); free.append(n)
+        adding_names.update(keys)
+    return free
+
+def release_names(names):
+    adding_names.difference_update(norm_name(n) for n in names)
+
+async def add_supplier(values):
+    # values: [名稱, 圖片網址, 備註]；名稱已被使用時回傳 False
+    if not await claim_names([values[0]]): return False
+    try: await sheet_writer.append_row(values)
+    finally: release_names([values[0]])
+    return True
+
+# 上面的寫入在重試後仍失敗會拋出例外；對話流程回覆此訊息，可重試的步驟保留狀態讓管理員重新輸入
+WRITE_FAILED = "❌ 寫入試算表失敗，資料未變更"
+
+# ========== 2-4. 對話狀態 (有效期限 + 數量上限 + 可選 SQLite 保存) ==========
+# user_state 用法與 dict 相同 (in / [] / get / pop)，每個聊天室只存一筆精簡的流程資料：
+#   mode 以及該步驟需要的 name / old_name / upload (暫存圖檔 public_id)
+# 超過 FLOW_TTL 秒沒有進度的流程會被清掉；超過 MAX_FLOWS 時淘汰最久沒動的流程。
+# STATE_DB 有設定 (預設與快照同一個檔案) 時每次變動都寫入 SQLite，重新部署後流程可接續；設為空字串則只存在記憶體。
+FLOW_TTL = float(os.environ.get("FLOW_TTL", 30 * 60))
+FLOW_SWEEP_INTERVAL = float(os.environ.get("FLOW_SWEEP_INTERVAL", 60))
+MAX_FLOWS = int(os.environ.get("MAX_FLOWS", 1000))
+STATE_DB = os.environ.get("STATE_DB", CACHE_DB)
+
+class StateStore:
+    def __init__(self, ttl, max_flows, db_path="", on_drop=None):
+        self.ttl, self.max_flows, self.db_path, self.on_drop = ttl, max_flows, db_path, on_drop
+        # chat id -> (到期時間, 流程資料)；依最後更新時間排序，過期的一定在最前面
+        self.flows = OrderedDict()
+        # 單一執行緒依序寫入，避免同一聊天室的新增 / 刪除順序顛倒
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state") if db_path else None
+
+    def __contains__(self, uid):
+        return self.get(uid) is not None
+
+    def __getitem__(self, uid):
+        st = self.get(uid)
+        if st is None: raise KeyError(uid)
+        return st
+
+    def __setitem__(self, uid, st):
+        old = self.flows.pop(uid, None)
+        # 換成另一個流程時，舊流程視同放棄 (例如新增到一半改去刪除)
+        if old and old[1].get("mode") != st.get("mode"): self._drop(uid, old[1], persist=False)
+        expires = time.time() + self.ttl
+        self.flows[uid] = (expires, st)
+        while len(self.flows) > self.max_flows:
+            oldest, (_, ost) = self.flows.popitem(last=False)
+            self._drop(oldest, ost)
+        self._persist(uid, st, expires)
+
+    def __len__(self):
+        return len(self.flows)
+
+    def get(self, uid, default=None):
+        item = self.flows.get(uid)
+        if item is None: return default
+        if item[0] < time.time():
+            del self.flows[uid]; self._drop(uid, item[1])
+            return default
+        return item[1]
+
+    def pop(self, uid, default=None):
+        item = self.flows.pop(uid, None)
+        if item is None: return default
+        self._persist(uid, None)
+        return item[1]
+
+    def sweep(self):
+        now = time.time()
+        while self.flows:
+            uid, (expires, st) = next(iter(self.flows.items()))
+            if expires >= now: break
+            del self.flows[uid]; self._drop(uid, st)
+
+    def load(self):
+        if not self.db_path: return
+        try:
+            conn = self._connect()
+            data = conn.execute("SELECT chat_id, data, expires FROM flows ORDER BY expires").fetchall()
+            conn.close()
+        except Exception as e:
+            return print(f"⚠️ 對話狀態讀取失敗: {e}")
+        now = time.time()
+        for uid, st, expires in data:
+            if expires < now: self._drop(uid, json.loads(st))
+            else: self.flows[uid] = (expires, json.loads(st))
+        if self.flows: print(f"💬 已恢復 {len(self.flows)} 個進行中的流程")
+
+    def _drop(self, uid, st, persist=True):
+        if persist: self._persist(uid, None)
+        if self.on_drop: self.on_drop(uid, st)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("CREATE TABLE IF NOT EXISTS flows (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+        return conn
+
+    def _persist(self, uid, st, expires=0.0):
+        if self.writer: self.writer.submit(self._write, uid, st, expires)
+
+    def _write(self, uid, st, expires):
+        try:
+            with self._connect() as conn:
+                if st is None: conn.execute("DELETE FROM flows WHERE chat_id = ?", (uid,))
+                else: conn.execute("INSERT OR REPLACE INTO flows VALUES (?, ?, ?)", (uid, json.dumps(st, ensure_ascii=False), expires))
+            conn.close()
+        except Exception as e:
+            print(f"⚠️ 對話狀態寫入失敗: {e}")
+
+user_state = StateStore(FLOW_TTL, MAX_FLOWS, STATE_DB, on_drop=lambda uid, st: discard_upload(uid, st.get("upload")))
+
+async def sweep_flows():
+    while True:
+        await asyncio.sleep(FLOW_SWEEP_INTERVAL)
+        user_state.sweep()
+
+def end_flow(uid):
+    # 使用者主動終止：清除狀態並刪掉已上傳但用不到的圖檔
+    st = user_state.pop(uid, None)
+    discard_upload(uid, (st or {}).get("upload"))
+
+# ========== 2-5. 試算表變更偵測 (直接在 Google Sheets 上修改也能即時反映) ==========
+# 每 SHEET_POLL_INTERVAL 秒只查一次試算表的最後修改時間 (Drive metadata，不讀儲存格)；
+# 沒變就結束，有變才下載一次並與快取逐列比對，只把有差異的列套用到索引 (不重建、不重寫整份快照)。
+# 自己寫入後 SheetWriter 會推進修改時間的基準，不會因此重抓。比對與重建索引都在執行緒池中進行。
+# Sheets API 沒有「哪幾列變了」的查詢，所以有變動時仍需讀一次整張表；6 小時整包同步保留作為保險。
+SHEET_POLL_INTERVAL = float(os.environ.get("SHEET_POLL_INTERVAL", 30))  # 0 = 停用
+
+def sheet_diff(old_rows, rows):
+    # 回傳 [(位置, [(欄位, 新值)])]，只包含有差異的列
+    diff = []
+    for pos, old in enumerate(old_rows):
+        cells = [(col, rows[pos].get(key, "")) for col, key in enumerate(COLS, start=1) if old.get(key, "") != rows[pos].get(key, "")]
+        if cells: diff.append((pos, cells))
+    return diff
+
+async def sync_sheet_changes():
+    with timed(call_seconds, call_errors, (("service", "sheets"), ("op", "modified_time"))):
+        modified = await run_io(sheet_modified_time)
+    if modified is not None and modified == sheet_modified[0]:
+        sheet_polls["unchanged"] += 1
+        return 0
+    # 自己排隊中的寫入先送出，否則會被比對成「試算表上沒有」而還原
+    await sheet_writer.flush()
+    seen, old_rows, old_no = cache_version, list(search_index["rows"]), list(search_index["row_no"])
+    rows, row_no = await run_io(sheet_rows, await sheet_io("get_all_records"))
+    # 列號配置不同 (外部插入 / 刪除列) 時整份重建，否則只套用有差異的列
+    layout = row_no[:len(old_no)] != old_no
+    work = await run_io(build_index, rows, row_no) if layout else await run_io(sheet_diff, old_rows, rows)
+    with cache_lock:
+        stale = seen != cache_version
+        if layout and not stale: swap_index(work)
+    if stale:
+        # 下載或比對期間快取有局部更新，這份資料可能已過時，下一輪再比對
+        sheet_polls["retry"] += 1
+        return None
+    if not layout:
+        for pos, cells in work:
+            for col, value in cells: cache_update(row_no[pos], col, value)
+        # 只多出最後幾列 (外部直接在表尾新增)
+        for pos in range(len(old_no), len(rows)):
+            cache_append(row_no[pos], [rows[pos].get(key, "") for key in COLS])
+    changed = len(rows) if layout else len(work) + len(rows) - len(old_no)
+    sheet_modified[0], cache_synced_at[0] = modified, time.time()
+    sheet_polls["changed" if changed else "unchanged"] += 1
+    if changed:
+        print(f"🔎 偵測到試算表變更：{changed} 列已更新")
+        io_pool.submit(save_snapshot, list(search_index["rows"]), list(search_index["row_no"]))
+    return changed
+
+async def watch_sheet():
+    while True:
+        await asyncio.sleep(SHEET_POLL_INTERVAL)
+        try:
+            await sync_sheet_changes()
+        except Exception as e:
+            sheet_polls["error"] += 1
+            print(f"⚠️ 變更偵測失敗: {e}")
+
+# ========== 3. HTTP 伺服器 (健康檢查 + Webhook) ==========
+# 單一 asyncio 伺服器跑在 $PORT：
+#   GET/HEAD /health (或 /) : Render / UptimeRobot 防休眠用，HEAD 是 UptimeRobot 預設
+#   GET /metrics            : Prometheus 監控指標
+#   POST WEBHOOK_PATH       : BOT_MODE=webhook 時接收 Telegram 更新
+# 本機測試 webhook：不設 WEBHOOK_URL (不會向 Telegram 註冊)，直接把錄下的 update JSON 丟進來
+#   curl -X POST localhost:10000/telegram -H "Content-Type: application/json" -d @update.json
+# 有設 WEBHOOK_URL 時一定驗證 secret token：沒設 WEBHOOK_SECRET 就每次啟動隨機產生並向 Telegram 註冊，
+# 否則任何連得到 $PORT 的人都能偽造更新 (例如 /delete)
+PORT = int(os.environ.get("PORT", 10000))
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or (secrets.token_urlsafe(32) if WEBHOOK_URL else "")
+MAX_BODY_BYTES = 1024 * 1024
+HTTP_TIMEOUT = 10  # 讀取標頭與內容的逾時秒數，避免慢速連線一直佔著
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+async def route_http(method, path, headers, reader, app):
+    if method in ("GET", "HEAD") and path in ("/", "/health"):
+        return 200, b"OK"
+    if method in ("GET", "HEAD") and path == "/metrics":
+        return 200, render_metrics()
+    if method == "POST" and path == WEBHOOK_PATH and app is not None:
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if WEBHOOK_SECRET and not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return 403, b""
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES: return 413, b""
+        data = json.loads(await asyncio.wait_for(reader.readexactly(length), HTTP_TIMEOUT))
+        await app.update_queue.put(Update.de_json(data, app.bot))
+        return 200, b""
+    return 404, b""
+
+async def handle_http(reader, writer, app=None):
+    method = ""
+    try:
+        head = (await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_TIMEOUT)).decode("latin-1").split("\r\n")
+        method, target, _ = head[0].split(" ", 2)
+        headers = {k.strip().lower(): v.strip() for k, v in (h.split(":", 1) for h in head[1:] if ":" in h)}
+        status, body = await route_http(method, target.split("?", 1)[0], headers, reader, app)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+        status, body = 400, b""
+    except Exception as e:
+        print(f"❌ HTTP 請求處理失敗: {e}")
+        status, body = 500, b""
+    try:
+        writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: text/plain\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                     + (b"" if method == "HEAD" else body))
+        await writer.drain()
+    except ConnectionError: pass
+    finally:
+        writer.close()
+
+async def start_http_server(app=None):
+    server = await asyncio.start_server(functools.partial(handle_http, app=app), "0.0.0.0", PORT)
+    print(f"🌐 HTTP 伺服器啟動於 Port: {PORT} (健康檢查 GET/HEAD{'、Webhook ' + WEBHOOK_PATH if app else ''})")
+    return server
 
 # ========== 4. 每日同步 ==========
 def start_daily_refresh():
+    # 平時由變更偵測 (2-5) 即時同步；這裡的整包重新下載只是保險
     scheduler = BackgroundScheduler(daemon=True, timezone="Asia/Taipei")
     scheduler.add_job(refresh_cache, "interval", hours=6)
     scheduler.start()
@@ -123,7 +905,10 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/delete [名稱] - 刪除該筆資料與圖檔\n"
         "/editname [名稱] - 修改替換名稱\n"
         "/editinfo [名稱] - 修改替換備註\n"
-        "/editphoto [名稱] - 啟動換圖流程"
+        "/editphoto [名稱] - 啟動換圖流程\n\n"
+        "📦 <b>批次作業</b>\n"
+        "/import - 以 CSV / ZIP 檔批次新增\n"
+        "/export - 匯出所有資料為 CSV"
     )
     msg = update.callback_query.message if update.callback_query else update.message
     await msg.reply_text(text, reply_markup=get_main_keyboard(), parse_mode='HTML')
@@ -132,11 +917,11 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await help_cmd(update, context)
 
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_state.pop(update.effective_chat.id, None)
+    end_flow(update.effective_chat.id)
     await update.message.reply_text("🚫 已終止目前所有流程。")
 
 async def refresh_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    refresh_cache()
+    await refresh_cache_async()
     await update.message.reply_text("✅ 已成功同步雲端快取資料！")
 
 async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -151,12 +936,13 @@ async def supplier_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def delete_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name, uid = " ".join(context.args).strip(), update.effective_chat.id
     if name:
-        idx, _ = find_in_cache(name)
-        if idx:
-            sheet.delete_rows(idx)
-            try: cloudinary.uploader.destroy(f"supplier_bot/{name}")
-            except: pass
-            refresh_cache()
+        try: found = await delete_supplier(name)
+        except Exception as e:
+            print(f"❌ 刪除失敗: {e}")
+            return await update.message.reply_text(WRITE_FAILED)
+        if found:
+            try: await cloud_io("destroy", f"supplier_bot/{name}")
+            except Exception as e: print(f"⚠️ 刪除圖檔失敗: {e}")
             await update.message.reply_text(f"🗑️ 已刪除 {name}")
         else: await update.message.reply_text(f"❌ 找不到「{name}」")
     else:
@@ -180,7 +966,7 @@ async def editinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if name:
         idx, row = find_in_cache(name)
         if idx:
-            user_state[uid] = {"mode": "ei_step2", "name": name, "idx": idx}
+            user_state[uid] = {"mode": "ei_step2", "name": name}
             info = row.get('info', '無')
             await update.message.reply_text(
                 f"🔎 <b>找到遊戲商：【{name}】</b>\n"
@@ -205,67 +991,214 @@ async def editphoto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_state[uid] = {"mode": "ep_process"}
         await update.message.reply_text("🖼️ <b>更換圖片</b>\n請輸入要更換圖片的遊戲商：", parse_mode='HTML')
 
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_state[update.effective_chat.id] = {"mode": "import"}
+    await update.message.reply_text(
+        "📦 <b>批次匯入</b>\n請傳送 CSV 或 ZIP 檔案：\n"
+        "• CSV 欄位：<code>supplier,info</code> (可選 <code>image_url</code>、<code>image</code>)\n"
+        "• ZIP：內含一個 CSV 與圖片檔，圖片檔名為 <code>image</code> 欄位的值或「遊戲商名稱.jpg」\n"
+        "已存在或重複的名稱會略過。", parse_mode='HTML')
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = list(search_index["rows"])
+    data = await run_io(export_csv, rows)
+    await update.message.reply_document(document=data, filename=f"suppliers_{time.strftime('%Y%m%d_%H%M')}.csv",
+                                        caption=f"📦 共 {len(rows)} 筆遊戲商")
+
 # ========== 7. 搜尋與訊息處理核心 (整合點選複製功能) ==========
 
+async def send_supplier_photo(msg, row, caption, **kwargs):
+    # 有記錄到 file_id 且圖片網址沒變就直接用；Telegram 不認得 (過期) 時退回網址重傳
+    key, url = norm_name(row.get("supplier", "")), image_rendition(row.get("image_url", ""), "card")
+    cached = photo_ids.get(key)
+    if cached and cached[0] == url:
+        try:
+            return await msg.reply_photo(photo=cached[1], caption=caption, **kwargs)
+        except BadRequest as e:
+            print(f"⚠️ file_id 失效，改用網址: {e}")
+            photo_ids.pop(key, None)
+    sent = await msg.reply_photo(photo=url, caption=caption, **kwargs)
+    if sent and sent.photo:
+        photo_ids[key] = (url, sent.photo[-1].file_id)
+        io_pool.submit(save_photo_id, key, url, sent.photo[-1].file_id)
+    return sent
+
 async def perform_search(update, kw):
     # 從快取中搜尋符合關鍵字的遊戲商
-    res = [r for r in local_cache if kw.lower() in str(r.get("supplier", "")).strip().lower()]
+    with timed(call_seconds, call_errors, (("service", "cache"), ("op", "search"))):
+        res, total = search_cache(kw, RESULT_LIMIT)
     
     if not res: 
         return await update.message.reply_text(f"❌ 找不到與「{kw}」相關的遊戲商")
     
-    if len(res) > 1:
-        # 找到多筆，顯示按鈕選單
-        btns = [[InlineKeyboardButton(r['supplier'], callback_data=f"v_{r['supplier']}")] for r in res]
-        await update.message.reply_text(f"🔍 找到 {len(res)} 筆相似結果，請選擇：", reply_markup=InlineKeyboardMarkup(btns))
+    if total > 1:
+        # 找到多筆，結果存成短代號後分頁顯示按鈕選單
+        token = save_results(res, total)
+        text, markup = results_page(token, 0)
+        await update.message.reply_text(text, reply_markup=markup)
     else:
-        # 找到唯一結果，開始處理顯示邏輯
-        r = res[0]
-        supplier_name = r.get("supplier", "")
-        info_text = r.get("info", "") or "無"
-        image_url = r.get("image_url", "")
-
-        # --- 點選複製邏輯：如果是「值班常用語」才執行格式化 ---
-        if supplier_name == "值班常用語":
-            lines = info_text.split('\n')
-            # 將每一行內容用 <code> 標籤包裹，實現點擊複製
-            formatted_lines = [f"<code>{line.strip()}</code>" for line in lines if line.strip()]
-            final_text = f"📋 <b>{supplier_name}</b> (點擊文字可複製)\n\n" + "\n\n".join(formatted_lines)
+        # 找到唯一結果
+        await send_supplier_card(update.message, res[0])
+
+def supplier_card(r):
+    supplier_name = r.get("supplier", "")
+    info_text = r.get("info", "") or "無"
+    # --- 點選複製邏輯：如果是「值班常用語」才執行格式化 ---
+    if supplier_name == "值班常用語":
+        lines = info_text.split('\n')
+        # 將每一行內容用 <code> 標籤包裹，實現點擊複製
+        formatted_lines = [f"<code>{line.strip()}</code>" for line in lines if line.strip()]
+        return f"📋 <b>{supplier_name}</b> (點擊文字可複製)\n\n" + "\n\n".join(formatted_lines)
+    # 其他遊戲商保持原樣
+    return f"🎮 <b>遊戲商：</b>{supplier_name}\n📝 <b>備註：</b>{info_text}"
+
+async def send_supplier_card(msg, r):
+    final_text, image_url = supplier_card(r), r.get("image_url", "")
+    # --- 發送邏輯 ---
+    try:
+        if image_url and image_url.startswith("http"):
+            # 有圖片則發送圖片 + 說明
+            await send_supplier_photo(msg, r, final_text, parse_mode='HTML')
         else:
-            # 其他遊戲商保持原樣
-            final_text = f"🎮 <b>遊戲商：</b>{supplier_name}\n📝 <b>備註：</b>{info_text}"
+            # 無圖片則直接傳送文字
+            await msg.reply_text(final_text, parse_mode='HTML')
+    except Exception as e:
+        # 發生意外錯誤時的備用純文字方案
+        print(f"發送失敗: {e}")
+        await msg.reply_text(f"🎮 {r.get('supplier', '')}\n📝 {r.get('info', '') or '無'}")
+
+# ========== 7-0. 多筆結果分頁 ==========
+# 搜尋結果以短代號暫存 (callback_data 只帶代號與序號，不受名稱長度影響 64 bytes 上限)：
+#   v_{代號}_{序號} : 查看第 n 筆      p_{代號}_{頁碼} : 換頁
+# result_sets: 代號 -> (到期時間, 遊戲商名稱 list, 總筆數)，超過上限時淘汰最舊的
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 8))
+RESULT_LIMIT = int(os.environ.get("RESULT_LIMIT", 500))
+RESULT_TTL = float(os.environ.get("RESULT_TTL", 30 * 60))
+MAX_RESULT_SETS = int(os.environ.get("MAX_RESULT_SETS", 2000))
+result_sets = OrderedDict()
+
+def save_results(rows, total):
+    token = secrets.token_urlsafe(6)
+    result_sets[token] = (time.time() + RESULT_TTL, [r.get("supplier", "") for r in rows[:RESULT_LIMIT]], total)
+    while len(result_sets) > MAX_RESULT_SETS: result_sets.popitem(last=False)
+    return token
+
+def load_results(token):
+    item = result_sets.get(token)
+    if item and item[0] < time.time():
+        del result_sets[token]; item = None
+    return item
+
+def results_page(token, page):
+    _, names, total = result_sets[token]
+    pages = (len(names) + PAGE_SIZE - 1) // PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * PAGE_SIZE
+    btns = [[InlineKeyboardButton(n, callback_data=f"v_{token}_{start + i}")] for i, n in enumerate(names[start:start + PAGE_SIZE])]
+    if pages > 1:
+        nav = []
+        if page > 0: nav.append(InlineKeyboardButton("⬅️ 上一頁", callback_data=f"p_{token}_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1} / {pages}", callback_data="noop"))
+        if page < pages - 1: nav.append(InlineKeyboardButton("下一頁 ➡️", callback_data=f"p_{token}_{page + 1}"))
+        btns.append(nav)
+    text = f"🔍 找到 {total} 筆相似結果，請選擇："
+    if total > len(names): text += f"\n(僅列出最相關的 {len(names)} 筆，請輸入更完整的關鍵字)"
+    return text, InlineKeyboardMarkup(btns)
+
+# ========== 7-1. 圖片上傳 (記憶體直傳 Cloudinary) ==========
+# 新增流程：收到圖片即上傳到暫存 public_id，輸入名稱後改名為正式名稱，輸入備註時通常已完成
+# pending_uploads: chat id -> (背景 task, 該 task 完成後圖檔所在的 public_id)
+# 圖檔目前所在的 public_id 也記在流程狀態的 upload 欄位，重新啟動後 task 雖然不見了仍可接續
+MAX_PHOTO_BYTES = int(os.environ.get("MAX_PHOTO_BYTES", 10 * 1024 * 1024))
+pending_uploads = {}
+
+def pick_photo(sizes):
+    # Telegram 會提供多種尺寸；取最長邊不超過 IMAGE_MAX_DIM 的最大一張，不必下載原圖
+    fit = [p for p in sizes if max(p.width, p.height) <= IMAGE_MAX_DIM]
+    return fit[-1] if fit else sizes[0]
+
+async def download_photo(context, photo):
+    if photo.file_size and photo.file_size > MAX_PHOTO_BYTES: return None
+    data = await (await context.bot.get_file(photo.file_id)).download_as_bytearray()
+    return bytes(data) if len(data) <= MAX_PHOTO_BYTES else None
 
-        # --- 發送邏輯 ---
+async def _upload_staged(data, public_id):
+    return (await cloud_io("upload", data, public_id=public_id, **UPLOAD_OPTS))["secure_url"]
+
+async def _promote_staged(task, tmp_id, name):
+    if task: await task
+    # 不覆寫：同名圖檔已存在 (其他聊天室剛新增同名) 時改名失敗，不會蓋掉對方的圖
+    res = await cloud_io("rename", tmp_id, f"supplier_bot/{name}")
+    try: await cloud_io("update", f"supplier_bot/{name}", display_name=name)
+    except Exception as e: print(f"⚠️ 圖檔顯示名稱更新失敗: {e}")
+    return res["secure_url"]
+
+def stage_upload(uid, data, public_id):
+    discard_upload(uid)
+    pending_uploads[uid] = (asyncio.create_task(_upload_staged(data, public_id)), public_id)
+
+def promote_upload(uid, tmp_id, name):
+    task, _ = pending_uploads.get(uid, (None, tmp_id))
+    pending_uploads[uid] = (asyncio.create_task(_promote_staged(task, tmp_id, name)), f"supplier_bot/{name}")
+    return f"supplier_bot/{name}"
+
+async def finish_upload(uid, public_id):
+    # 回傳圖片網址；重新啟動後沒有背景 task，直接向 Cloudinary 查詢已上傳的圖檔
+    task, _ = pending_uploads.pop(uid, (None, public_id))
+    if task: return await task
+    return (await cloud_io("resource", public_id))["secure_url"]
+
+def discard_upload(uid, public_id=None):
+    # 流程中止：等背景上傳結束後刪掉已上傳的圖檔
+    task, public_id = pending_uploads.pop(uid, (None, public_id))
+    if not public_id: return
+    async def cleanup():
         try:
-            if image_url and image_url.startswith("http"):
-                # 有圖片則發送圖片 + 說明
-                await update.message.reply_photo(
-                    photo=image_url, 
-                    caption=final_text, 
-                    parse_mode='HTML'
-                )
-            else:
-                # 無圖片則直接傳送文字
-                await update.message.reply_text(final_text, parse_mode='HTML')
-        except Exception as e:
-            # 發生意外錯誤時的備用純文字方案
-            print(f"發送失敗: {e}")
-            await update.message.reply_text(f"🎮 {supplier_name}\n📝 {info_text}")
+            if task: await task
+        except Exception: return
+        try: await cloud_io("destroy", public_id)
+        except Exception as e: print(f"⚠️ 暫存圖檔刪除失敗: {e}")
+    asyncio.create_task(cleanup())
 
 async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid, msg = update.effective_chat.id, update.message
     if not msg: return
     
+    # 處理批次匯入檔案
+    if msg.document and uid in user_state:
+        if user_state[uid]["mode"] != "import": return
+        doc = msg.document
+        if doc.file_size and doc.file_size > MAX_IMPORT_BYTES:
+            return await msg.reply_text(f"⚠️ 檔案超過 {MAX_IMPORT_BYTES // (1024 * 1024)} MB，請分批匯入")
+        data = bytes(await (await context.bot.get_file(doc.file_id)).download_as_bytearray())
+        user_state.pop(uid); await msg.reply_text("⏳ 匯入中，請稍候…")
+        return await import_suppliers(msg, data, doc.file_name or "")
+
     # 處理照片上傳 (新增或修改圖片)
     if msg.photo and uid in user_state:
         st = user_state[uid]
-        path = f"/tmp/{uid}.jpg"
-        await (await context.bot.get_file(msg.photo[-1].file_id)).download_to_drive(path)
+        if st["mode"] not in ("add", "edit_photo_process"): return
+        data = await download_photo(context, pick_photo(msg.photo))
+        if data is None:
+            return await msg.reply_text(f"⚠️ 圖片超過 {MAX_PHOTO_BYTES // (1024 * 1024)} MB，請壓縮後重新傳送")
         if st["mode"] == "add":
-            user_state[uid]["path"] = path
+            # 收到圖片就先在背景上傳，同時讓管理員輸入名稱與備註
+            tmp_id = f"supplier_bot/_pending/{uid}_{msg.message_id}"
+            stage_upload(uid, data, tmp_id)
+            user_state[uid] = {"mode": "add", "upload": tmp_id}
             await msg.reply_text("✍️ 請輸入新遊戲商名稱：")
         elif st["mode"] == "edit_photo_process":
-            cloudinary.uploader.upload(path, folder="supplier_bot", public_id=st["name"], display_name=st["name"], overwrite=True)
+            res = await cloud_io("upload", data, folder="supplier_bot", public_id=st["name"], display_name=st["name"],
+                                 overwrite=True, **UPLOAD_OPTS)
+            # 新的版本號網址寫回 B 欄，之後傳送時 Telegram / CDN 才不會沿用舊圖
+            # 寫入失敗時保留流程，重新傳送圖片即可再試一次
+            try: found = await update_supplier(st["name"], [(2, res["secure_url"])])
+            except Exception as e:
+                print(f"❌ 圖片網址寫入失敗: {e}")
+                return await msg.reply_text(f"{WRITE_FAILED}，請重新傳送圖片")
+            if not found:
+                user_state.pop(uid); return await msg.reply_text(f"❌ 找不到「{st['name']}」，可能已被刪除")
+            forget_photo_id(st["name"])
             user_state.pop(uid); await msg.reply_text(f"✅ 【{st['name']}】群組圖片更新完成！")
         return
 
@@ -280,12 +1213,23 @@ async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if st["mode"] == "add":
                 if "name" not in st:
                     if find_in_cache(txt)[0]: return await msg.reply_text("⚠️ 名稱已存在")
-                    user_state[uid]["name"] = txt
+                    if "upload" not in st: return await msg.reply_text("📸 請先傳送遊戲商群組圖片：")
+                    user_state[uid] = {**st, "name": txt, "upload": promote_upload(uid, st["upload"], txt)}
                     await msg.reply_text(f"📝 請輸入【{txt}】的備註：")
                 else:
-                    res = cloudinary.uploader.upload(st["path"], folder="supplier_bot", public_id=st["name"], display_name=st["name"])
-                    sheet.append_row([st["name"], res["secure_url"], txt])
-                    refresh_cache(); user_state.pop(uid); await msg.reply_text("✅ 新增成功！")
+                    try: url = await finish_upload(uid, st["upload"])
+                    except Exception as e:
+                        print(f"❌ 圖片上傳失敗: {e}"); user_state.pop(uid)
+                        return await msg.reply_text("❌ 圖片上傳失敗，請重新開始新增流程")
+                    # 寫入失敗時保留流程 (圖檔已在正式位置)，重新輸入備註即可再試一次
+                    try: added = await add_supplier([st["name"], url, txt])
+                    except Exception as e:
+                        print(f"❌ 新增寫入失敗: {e}")
+                        return await msg.reply_text(f"{WRITE_FAILED}，請重新輸入備註")
+                    user_state.pop(uid)
+                    # 名稱在輸入後才被其他聊天室新增：不寫入，也不刪圖檔 (該 public_id 可能是對方的圖)
+                    if not added: return await msg.reply_text(f"⚠️ 名稱「{st['name']}」已被新增，請重新開始新增流程")
+                    await msg.reply_text("✅ 新增成功！")
             
             # --- 修改名稱 ---
             elif st["mode"] == "en_step1":
@@ -296,33 +1240,54 @@ async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 else: await msg.reply_text("❌ 找不到此遊戲商，請重新輸入：")
             elif st["mode"] == "en_step2":
                 old_name = st["old_name"]
-                idx = find_in_cache(old_name)[0]
-                sheet.update_cell(idx, 1, txt)
+                if not find_in_cache(old_name)[0]:
+                    user_state.pop(uid); return await msg.reply_text(f"❌ 找不到「{old_name}」，可能已被刪除")
+                # 先改圖檔 (不佔用列號鎖)，名稱與圖片網址兩格再合併成同一批寫入
+                cells = [(1, txt)]
                 try:
-                    cloudinary.uploader.rename(f"supplier_bot/{old_name}", f"supplier_bot/{txt}", overwrite=True)
-                    cloudinary.api.update(f"supplier_bot/{txt}", display_name=txt)
-                    new_url = f"https://res.cloudinary.com/{os.environ['CLOUDINARY_CLOUD_NAME']}/image/upload/supplier_bot/{txt}"
-                    sheet.update_cell(idx, 2, new_url)
-                except: pass
-                refresh_cache(); user_state.pop(uid); await msg.reply_text(f"✅ 已將名稱改為【{txt}】")
+                    res = await cloud_io("rename", f"supplier_bot/{old_name}", f"supplier_bot/{txt}", overwrite=True)
+                    cells.append((2, res["secure_url"]))
+                    await cloud_io("update", f"supplier_bot/{txt}", display_name=txt)
+                except Exception as e: print(f"⚠️ 圖檔改名失敗: {e}")
+                try: found = await update_supplier(old_name, cells)
+                except Exception as e:
+                    # 試算表仍是舊名稱與舊網址，把圖檔改回原名後結束流程
+                    print(f"❌ 名稱寫入失敗: {e}"); user_state.pop(uid)
+                    if len(cells) > 1:
+                        try: await cloud_io("rename", f"supplier_bot/{txt}", f"supplier_bot/{old_name}", overwrite=True)
+                        except Exception as e: print(f"⚠️ 圖檔改回原名失敗: {e}")
+                    return await msg.reply_text(f"{WRITE_FAILED}，請重新開始改名流程")
+                if not found:
+                    user_state.pop(uid); return await msg.reply_text(f"❌ 找不到「{old_name}」，可能已被刪除")
+                forget_photo_id(old_name); forget_photo_id(txt)
+                user_state.pop(uid); await msg.reply_text(f"✅ 已將名稱改為【{txt}】")
             
             # --- 修改備註 ---
             elif st["mode"] == "ei_step1":
                 idx, row = find_in_cache(txt)
                 if idx:
-                    user_state[uid] = {"mode": "ei_step2", "name": txt, "idx": idx}
+                    user_state[uid] = {"mode": "ei_step2", "name": txt}
                     await msg.reply_text(f"🔎 <b>找到【{txt}】</b>\n目前備註：<code>{row.get('info', '無')}</code>\n\n👆 請輸入新備註：", parse_mode='HTML')
                 else: await msg.reply_text("❌ 找不到此遊戲商，請重新輸入：")
             elif st["mode"] == "ei_step2":
-                sheet.update_cell(st["idx"], 3, txt)
-                refresh_cache(); user_state.pop(uid); await msg.reply_text(f"✅ 備註更新成功！\n【{st['name']}】的新備註為：\n<code>{txt}</code>", parse_mode='HTML')
+                try: found = await update_supplier(st["name"], [(3, txt)])
+                except Exception as e:
+                    print(f"❌ 備註寫入失敗: {e}")
+                    return await msg.reply_text(f"{WRITE_FAILED}，請重新輸入備註")
+                if not found:
+                    user_state.pop(uid); return await msg.reply_text(f"❌ 找不到「{st['name']}」，可能已被刪除")
+                user_state.pop(uid); await msg.reply_text(f"✅ 備註更新成功！\n【{st['name']}】的新備註為：\n<code>{txt}</code>", parse_mode='HTML')
             
             # --- 刪除 ---
             elif st["mode"] == "del_process":
-                idx, _ = find_in_cache(txt)
-                if idx:
-                    sheet.delete_rows(idx); cloudinary.uploader.destroy(f"supplier_bot/{txt}")
-                    refresh_cache(); user_state.pop(uid); await msg.reply_text(f"🗑️ 已刪除 {txt}")
+                try: found = await delete_supplier(txt)
+                except Exception as e:
+                    print(f"❌ 刪除失敗: {e}")
+                    return await msg.reply_text(f"{WRITE_FAILED}，請重新輸入要刪除的遊戲商")
+                if found:
+                    try: await cloud_io("destroy", f"supplier_bot/{txt}")
+                    except Exception as e: print(f"⚠️ 刪除圖檔失敗: {e}")
+                    user_state.pop(uid); await msg.reply_text(f"🗑️ 已刪除 {txt}")
                 else: await msg.reply_text("❌ 找不到此遊戲商")
             
             # --- 修改圖片 ---
@@ -336,6 +1301,157 @@ async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # 如果沒有進入任何管理模式，則視為一般關鍵字搜尋
             await perform_search(update, txt)
 
+# ========== 7-2. Inline 查詢 (@bot 關鍵字，需先在 BotFather 開啟 /setinline) ==========
+# 只讀記憶體快取，打字過程中不會呼叫 Sheets / Cloudinary。
+# 伺服器端以「正規化關鍵字」記住最近的結果 (依序的 id)；新關鍵字若以已記住的關鍵字開頭，只需在其結果中再篩選。
+# 快取內容變動 (cache_version 改變) 時整批作廢；Telegram 端另以 cache_time 快取相同關鍵字的回應。
+INLINE_PAGE = 50  # Telegram 每次回應最多 50 筆
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))
+INLINE_MEMO = int(os.environ.get("INLINE_MEMO", 500))               # 最多記住幾組關鍵字
+INLINE_MEMO_ROWS = int(os.environ.get("INLINE_MEMO_ROWS", 200_000))  # 所有結果加總最多幾筆
+INLINE_FILTER_MAX = 5000  # 前綴結果超過這個數量時，直接查 n-gram 索引比較快
+inline_memo, inline_memo_version, inline_memo_rows = OrderedDict(), [None, None], [0]
+
+def inline_matches(kw):
+    # 回傳 (索引, 依序的 id)；整包同步可能在其他執行緒替換索引，id 一律從同一份索引取出資料
+    q, idx = norm_name(kw), search_index
+    if inline_memo_version[0] != cache_version or inline_memo_version[1] is not idx:
+        inline_memo.clear(); inline_memo_version[:], inline_memo_rows[0] = [cache_version, idx], 0
+    if q in inline_memo:
+        inline_memo.move_to_end(q)
+        return idx, inline_memo[q]
+    base = next((inline_memo[q[:i]] for i in range(len(q) - 1, 0, -1) if q[:i] in inline_memo), None)
+    if base is not None and len(base) <= INLINE_FILTER_MAX:
+        # 以前綴的結果重新篩選，並依新關鍵字重新排序 (同級依試算表列號，與 search_cache 一致)
+        ranked = rank_matches(idx, q, base)
+    else:
+        ranked = rank_matches(idx, q, search_candidates(idx, q))
+    res = [rid for _, _, rid in sorted(ranked)]
+    inline_memo[q] = res; inline_memo_rows[0] += len(res)
+    while len(inline_memo) > 1 and (len(inline_memo) > INLINE_MEMO or inline_memo_rows[0] > INLINE_MEMO_ROWS):
+        inline_memo_rows[0] -= len(inline_memo.popitem(last=False)[1])
+    return idx, res
+
+def inline_result(rid, r):
+    card, url = supplier_card(r), r.get("image_url", "")
+    photo, thumb = image_rendition(url, "card"), image_rendition(url, "thumb")
+    name, info = r.get("supplier", ""), (r.get("info", "") or "無")[:100]
+    # 有圖片且說明不超過 caption 上限時送圖片卡，否則送文字卡 (值班常用語的點選複製格式同一般搜尋)
+    if url.startswith("http") and len(card) <= 1024:
+        cached = photo_ids.get(norm_name(name))
+        if cached and cached[0] == photo:
+            return InlineQueryResultCachedPhoto(rid, cached[1], title=name, description=info, caption=card, parse_mode='HTML')
+        return InlineQueryResultPhoto(rid, photo, thumb, title=name, description=info, caption=card, parse_mode='HTML')
+    return InlineQueryResultArticle(rid, name, InputTextMessageContent(card, parse_mode='HTML'), description=info,
+                                    thumbnail_url=thumb if url.startswith("http") else None)
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    kw, offset = query.query.strip(), int(query.offset or 0)
+    if not kw:
+        return await query.answer([], cache_time=INLINE_CACHE_TIME)
+    with timed(call_seconds, call_errors, (("service", "cache"), ("op", "inline"))):
+        idx, res = inline_matches(kw)
+    page = [idx["recs"][rid] for rid in res[offset:offset + INLINE_PAGE]]
+    results = [inline_result(str(offset + i), r) for i, r in enumerate(page)]
+    more = offset + INLINE_PAGE < len(res)
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=str(offset + INLINE_PAGE) if more else "")
+
+# ========== 7-3. 批次匯入 / 匯出 ==========
+# 匯入檔為 CSV 或 ZIP (一個 CSV + 圖片檔)；CSV 可用 UTF-8 或 Excel 預設的 Big5 (cp950) 編碼。
+# 圖片以獨立的執行緒池同時上傳 (不佔用一般 I/O 的執行緒)，全部完成後以一次 append_rows 寫入並就地更新快取。
+IMPORT_CONCURRENCY = int(os.environ.get("IMPORT_CONCURRENCY", 8))
+MAX_IMPORT_BYTES = 20 * 1024 * 1024  # Telegram Bot API 可下載的檔案上限
+MAX_IMPORT_ROWS = int(os.environ.get("MAX_IMPORT_ROWS", 5000))
+MAX_IMPORT_CSV_BYTES = 20 * 1024 * 1024  # ZIP 內 CSV 解壓後的上限，避免壓縮炸彈
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+import_pool = ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY, thread_name_prefix="import")
+
+def export_csv(rows):
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(COLS)
+    out.writerows([r.get(key, "") for key in COLS] for r in rows)
+    return buf.getvalue().encode("utf-8-sig")  # 加 BOM，Excel 開啟時中文不會亂碼
+
+def parse_import(data, filename):
+    # 回傳 (CSV 資料列, 圖片 {小寫的路徑 / 檔名 / 主檔名: ZipInfo}, ZipFile 或 None)
+    zf, images = None, {}
+    if filename.lower().endswith(".zip") or zipfile.is_zipfile(io.BytesIO(data)):
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        members = [i for i in zf.infolist() if not i.is_dir() and not os.path.basename(i.filename).startswith(".")]
+        sheets = [i for i in members if i.filename.lower().endswith(".csv")]
+        if not sheets: raise ValueError("ZIP 內找不到 CSV 檔")
+        if sheets[0].file_size > MAX_IMPORT_CSV_BYTES: raise ValueError("CSV 檔過大，請分批匯入")
+        for info in members:
+            base = os.path.basename(info.filename).lower()
+            if base.endswith(IMAGE_EXTS):
+                images[info.filename.lower()] = images[base] = info
+                images.setdefault(os.path.splitext(base)[0], info)
+        data = zf.read(sheets[0])
+    try: text = data.decode("utf-8-sig")
+    except UnicodeDecodeError: text = data.decode("cp950")
+    rows = [{str(k).strip().lower(): str(v or "").strip() for k, v in r.items() if k} for r in csv.DictReader(io.StringIO(text))]
+    if rows and "supplier" not in rows[0]: raise ValueError("CSV 缺少 supplier 欄位")
+    return rows, images, zf
+
+async def import_image(sem, zf, name, src):
+    # src 為 ZIP 內的圖檔 (ZipInfo，在執行緒池中解壓) 或外部網址
+    async with sem:
+        if isinstance(src, zipfile.ZipInfo): src = await run_io(zf.read, src, executor=import_pool)
+        res = await cloud_io("upload", src, folder="supplier_bot", public_id=name, display_name=name, overwrite=True,
+                             executor=import_pool, **UPLOAD_OPTS)
+    return res["secure_url"]
+
+async def import_suppliers(msg, data, filename):
+    start = time.perf_counter()
+    try: rows, images, zf = await run_io(parse_import, data, filename)
+    except Exception as e: return await msg.reply_text(f"❌ 無法讀取匯入檔：{e}")
+    if len(rows) > MAX_IMPORT_ROWS: return await msg.reply_text(f"⚠️ 一次最多匯入 {MAX_IMPORT_ROWS} 筆，請分批匯入")
+
+    # 略過空白、檔案內重複及已存在的名稱；其餘名稱在上傳圖片前先佔用，寫入結束才釋放，
+    # 上傳期間其他聊天室新增同名時不會寫出重複的列 (也不會覆蓋對方的圖檔)
+    rows = [r for r in rows if r.get("supplier", "")]
+    claimed = await claim_names([r["supplier"] for r in rows])
+    try: await import_claimed(msg, start, rows, images, zf, set(claimed))
+    finally: release_names(claimed)
+
+async def import_claimed(msg, start, rows, images, zf, claimed):
+    todo, skipped = [], []
+    own_url = f"res.cloudinary.com/{os.environ['CLOUDINARY_CLOUD_NAME']}/"
+    for r in rows:
+        name, url = r["supplier"], r.get("image_url", "")
+        if name not in claimed: skipped.append(name); continue
+        claimed.discard(name)
+        # ZIP 內的圖檔直接上傳；外部網址交給 Cloudinary 抓取；已在本帳號的網址直接沿用
+        image = r.get("image", "").lower()
+        info = images.get(image) or images.get(os.path.basename(image)) or images.get(name.lower())
+        if info and info.file_size <= MAX_PHOTO_BYTES: src = info
+        elif url.startswith("http") and own_url not in url: src = url
+        else: src = None
+        todo.append((name, src, url if src is None else "", r.get("info", "")))
+
+    sem = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    uploads = await asyncio.gather(*(import_image(sem, zf, name, src) for name, src, _, _ in todo if src is not None),
+                                   return_exceptions=True)
+    values, failed, results = [], [], iter(uploads)
+    for name, src, url, info in todo:
+        if src is not None:
+            url = next(results)
+            if isinstance(url, Exception):
+                print(f"⚠️ 匯入圖片讀取或上傳失敗 {name}: {url}"); failed.append(name); continue
+        values.append([name, url, info])
+
+    if values:
+        try: await sheet_writer.append_rows(values)
+        except Exception as e:
+            print(f"❌ 批次匯入寫入失敗: {e}")
+            return await msg.reply_text(f"❌ 寫入試算表失敗，請稍後重試：{e}")
+    text = f"✅ 匯入完成：新增 {len(values)} 筆 (上傳 {len(uploads) - len(failed)} 張圖片，{time.perf_counter() - start:.1f} 秒)"
+    if skipped: text += f"\n⏭️ 略過 {len(skipped)} 筆已存在或重複的名稱：{', '.join(skipped[:10])}{' …' if len(skipped) > 10 else ''}"
+    if failed: text += f"\n❌ {len(failed)} 筆圖片讀取或上傳失敗未匯入：{', '.join(failed[:10])}{' …' if len(failed) > 10 else ''}"
+    await msg.reply_text(text)
+
 # ========== 8. 按鈕回調處理 ==========
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -343,7 +1459,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid, data = query.message.chat_id, query.data
     
     if data == 'm_cancel':
-        user_state.pop(uid, None); await query.message.reply_text("🚫 已終止目前流程。")
+        end_flow(uid); await query.message.reply_text("🚫 已終止目前流程。")
     elif data == 'm_admin_menu':
         await query.edit_message_text("🛠️ <b>進階管理模式</b>", reply_markup=get_admin_keyboard(), parse_mode='HTML')
     elif data == 'm_main_menu':
@@ -362,7 +1478,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/delete [名稱] - 刪除該筆資料與圖檔\n"
             "/editname [名稱] - 修改替換名稱\n"
             "/editinfo [名稱] - 修改替換備註\n"
-            "/editphoto [名稱] - 啟動換圖流程"
+            "/editphoto [名稱] - 啟動換圖流程\n\n"
+            "📦 <b>批次作業</b>\n"
+            "/import - 以 CSV / ZIP 檔批次新增\n"
+            "/export - 匯出所有資料為 CSV"
         )
         await query.edit_message_text(help_text, reply_markup=get_main_keyboard(), parse_mode='HTML')
     elif data == 'm_add':
@@ -376,58 +1495,131 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == 'm_del_hint':
         user_state[uid] = {"mode": "del_process"}; await query.message.reply_text("🗑️ <b>刪除流程</b>\n請輸入要刪除的遊戲商", parse_mode='HTML')
     elif data == 'm_ref':
-        refresh_cache(); await query.message.reply_text("✅ 已成功同步雲端快取資料！")
+        await refresh_cache_async(); await query.message.reply_text("✅ 已成功同步雲端快取資料！")
+    elif data.startswith('p_'):
+        token, _, page = data[2:].rpartition('_')
+        if not load_results(token): return await query.message.reply_text("⌛ 搜尋結果已過期，請重新搜尋")
+        text, markup = results_page(token, int(page))
+        await query.edit_message_text(text, reply_markup=markup)
     elif data.startswith('v_'):
-        _, row = find_in_cache(data[2:])
-        if row: await query.message.reply_photo(photo=row["image_url"], caption=f"🎮 {row['supplier']}\n📝 {row['info']}")
+        token, _, pos = data[2:].rpartition('_')
+        item = load_results(token) if pos.isdigit() else None
+        if item and int(pos) < len(item[1]): name = item[1][int(pos)]
+        # 舊版按鈕直接帶名稱 (v_{名稱})
+        elif find_in_cache(data[2:])[0]: name = data[2:]
+        else: return await query.message.reply_text("⌛ 搜尋結果已過期，請重新搜尋")
+        _, row = find_in_cache(name)
+        if row: await send_supplier_card(query.message, row)
+        else: await query.message.reply_text(f"❌ 找不到「{name}」，可能已被刪除")
 
 
 # ========== 9. 啟動 ==========
-if __name__ == "__main__":
-    
-    # 啟動 Render 所需的 Web Server 執行 (防休眠)
-    threading.Thread(target=start_health_server, daemon=True).start()
+# 不同聊天室的更新同時處理；同一聊天室依到達順序逐一處理 (對話流程狀態不會互相覆蓋)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
 
-    # 啟動每日自動同步排程
-    start_daily_refresh()
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = {}  # chat id -> [asyncio.Lock, 等待中的更新數]
 
-    # 初始化 Telegram Application
-    app = ApplicationBuilder().token(TOKEN).build()
+    async def process_update(self, update, coroutine):
+        # 先排聊天室的鎖、輪到時才佔用全域名額；同一聊天室排隊中的更新不會佔住其他聊天室的名額
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            return await super().process_update(update, coroutine)
+        entry = self.chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]: self.chat_locks.pop(chat.id, None)
 
-    # 註冊所有處理器 (Handler)
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("cancel", cancel_cmd))
-    app.add_handler(CommandHandler("refresh", refresh_cmd))
-    app.add_handler(CommandHandler("add", add_cmd))
-    app.add_handler(CommandHandler("supplier", supplier_cmd))
-    app.add_handler(CommandHandler("delete", delete_cmd))
-    app.add_handler(CommandHandler("editname", editname_cmd))
-    app.add_handler(CommandHandler("editinfo", editinfo_cmd))
-    app.add_handler(CommandHandler("editphoto", editphoto_cmd))
-
-    app.add_handler(CallbackQueryHandler(callback_handler))
-    app.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.PHOTO, handle_all))
-
-    # --- 採用雲端穩定啟動方案 ---避免在 Render 產生 Event Loop 衝突
-    asyncio.set_event_loop(asyncio.new_event_loop())
-    try:
-        loop = asyncio.get_event_loop()
-        
-        # 1. 初始化
-        loop.run_until_complete(app.initialize())
-        # 2. 啟動Bot
-        loop.run_until_complete(app.start())
-        # 3. 手動啟用run_polling：啟動「接收訊息」的 Polling
-        loop.run_until_complete(app.updater.start_polling())
-        # 4. 保持運作
-        loop.run_forever()
-    except (KeyboardInterrupt, SystemExit):
-        # 停止時的清理動作
-        loop.run_until_complete(app.updater.stop())
-        loop.run_until_complete(app.stop())
-        loop.run_until_complete(app.shutdown())
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
         pass
 
+async def warm_up(app):
+    # 先載入本機快照即可開始回應搜尋；Google 授權與 Telegram 初始化同時進行
+    load_snapshot(); user_state.load()
+    google = asyncio.ensure_future(run_io(get_sheet))
+    await app.initialize()
+    try: await google
+    except Exception as e: print(f"⚠️ Google 連線失敗，稍後同步時重試: {e}")
 
+def build_app():
+    # webhook 模式由 HTTP 伺服器把更新放進 update_queue，不需要 Updater
+    builder = (ApplicationBuilder().token(TOKEN).request(TimedRequest())
+               .concurrent_updates(ChatOrderedProcessor(MAX_CONCURRENT_UPDATES)))
+    if BOT_MODE == "webhook": builder = builder.updater(None)
+    app = builder.build()
 
+    # 註冊所有處理器 (Handler)
+    app.add_handler(CommandHandler("start", timed_handler(start_cmd)))
+    app.add_handler(CommandHandler("help", timed_handler(help_cmd)))
+    app.add_handler(CommandHandler("cancel", timed_handler(cancel_cmd)))
+    app.add_handler(CommandHandler("refresh", timed_handler(refresh_cmd)))
+    app.add_handler(CommandHandler("add", timed_handler(add_cmd)))
+    app.add_handler(CommandHandler("supplier", timed_handler(supplier_cmd)))
+    app.add_handler(CommandHandler("delete", timed_handler(delete_cmd)))
+    app.add_handler(CommandHandler("editname", timed_handler(editname_cmd)))
+    app.add_handler(CommandHandler("editinfo", timed_handler(editinfo_cmd)))
+    app.add_handler(CommandHandler("editphoto", timed_handler(editphoto_cmd)))
+    app.add_handler(CommandHandler("import", timed_handler(import_cmd)))
+    app.add_handler(CommandHandler("export", timed_handler(export_cmd)))
+
+    app.add_handler(CallbackQueryHandler(timed_handler(callback_handler)))
+    app.add_handler(InlineQueryHandler(timed_handler(inline_query)))
+    app.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.Document.ALL, timed_handler(handle_all)))
+    return app
+
+async def main():
+    app = build_app()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+
+    # 1. 先開 HTTP 伺服器，讓 Render 盡快偵測到 Port
+    server = await start_http_server(app if BOT_MODE == "webhook" else None)
+    # 2. 啟動每日自動同步排程
+    start_daily_refresh()
+    # 3. 初始化 (載入快照 + 並行建立 Google 連線) 並啟動 Bot
+    await warm_up(app)
+    await app.start()
+    # 4. 開始接收訊息：webhook 或 polling (備用方案)
+    if BOT_MODE == "webhook":
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                      allowed_updates=Update.ALL_TYPES)
+        print(f"🪝 Webhook 模式：{WEBHOOK_URL or '(未註冊，僅本機測試)'}{WEBHOOK_PATH}")
+    else:
+        await app.updater.start_polling()
+        print("🔁 Polling 模式")
+    # 5. 開始接收訊息後，背景再與試算表比對一次，並定期清除逾時的流程、偵測試算表變更
+    revalidate = asyncio.create_task(refresh_cache_async())
+    sweeper = asyncio.create_task(sweep_flows())
+    watcher = asyncio.create_task(watch_sheet()) if SHEET_POLL_INTERVAL > 0 else None
+    try:
+        await stop.wait()
+    finally:
+        # 停止時的清理動作
+        revalidate.cancel(); sweeper.cancel()
+        if watcher: watcher.cancel()
+        server.close()
+        await sheet_writer.flush()
+        if app.updater and app.updater.running: await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass